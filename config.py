@@ -9,10 +9,26 @@ TOP_GAINERS_LIMIT = 2500
 # Recommended: 350, adjust based on market activity
 BOT_TRANSACTION_THRESHOLD = 350
 
+# Number of top-scoring traders whose holdings are fetched
+# Recommended: 500, lower-ranked traders rarely reach the top 300
+HOLDINGS_FETCH_CAP = 500
+
 # Minimum USD value to be considered a significant holding
 # Recommended: $9000, adjust based on portfolio sizes you want to track
 SIGNIFICANT_HOLDING_THRESHOLD = 9000
 
 # Minimum number of significant holdings required
 # Recommended: 2 for diversification analysis
-MIN_SIGNIFICANT_HOLDINGS = 2 
\ No newline at end of file
+MIN_SIGNIFICANT_HOLDINGS = 2 
+
+# Maximum number of Birdeye requests in flight at once
+# Recommended: 10, raising it only helps if the rate limit below allows it
+MAX_CONCURRENT_REQUESTS = 10
+
+# Birdeye API rate limit (requests per second)
+# Recommended: 2, matches the public API tier
+BIRDEYE_REQUESTS_PER_SECOND = 2
+
+# How long cached wallet holdings stay valid between runs (hours)
+# Recommended: 6, holdings change slowly relative to daily runs
+HOLDINGS_CACHE_TTL_HOURS = 6
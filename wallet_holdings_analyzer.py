@@ -1,8 +1,15 @@
 import sys
+import csv
 import pandas as pd
-import requests
+import asyncio
+import httpx
+import heapq
+import json
+import sqlite3
 import time
-from datetime import datetime
+from aiolimiter import AsyncLimiter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from dataclasses import dataclass
 import logging
 import os
@@ -17,6 +24,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Number of top holdings written per wallet to the output CSV
+TOP_HOLDINGS_OUTPUT = 5
+
 @dataclass
 class TraderMetrics:
     """Stores processed trader metrics"""
@@ -36,50 +46,178 @@ class WalletAnalyzer:
             "accept": "application/json",
             "x-chain": "solana"
         }
-        self.last_call_time = 0
-        self.min_call_interval = 0.5  # 500ms between calls
-        self.holdings_cache = {}  # Cache for wallet holdings
+        self.min_call_interval = 1 / config.BIRDEYE_REQUESTS_PER_SECOND
         self.backoff_time = self.min_call_interval
+        self.max_backoff_time = 30  # Upper bound when several workers hit 429 at once
+        self.resume_at = 0.0  # Monotonic deadline before which no worker may send requests
         self.max_retries = 3
+        # Holdings kept per wallet, enough for both the CSV and the qualification check
+        self.holdings_limit = max(TOP_HOLDINGS_OUTPUT, config.MIN_SIGNIFICANT_HOLDINGS)
+        self.cache_db = self._open_cache_db()  # Holdings persisted across runs
+        self.holdings_cache = self._load_cached_holdings()  # Cache for wallet holdings
+        self.pending_cache_writes = 0
+        self.max_rate_limit_retries = 10  # Separate budget, 429s are expected under load
+        # Token bucket shared by all concurrent requests
+        self.limiter = AsyncLimiter(config.BIRDEYE_REQUESTS_PER_SECOND, 1)
+        self.semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_REQUESTS)
+        self.client = None
+
+    def _open_cache_db(self):
+        """Open the on-disk holdings cache, creating it if needed"""
+        os.makedirs("cache", exist_ok=True)
+        conn = sqlite3.connect("cache/holdings.db")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS holdings("
+            "wallet TEXT PRIMARY KEY, ts INTEGER, json TEXT, max_holdings INTEGER)"
+        )
+        # Caches created before max_holdings existed were capped at TOP_HOLDINGS_OUTPUT
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(holdings)")]
+        if 'max_holdings' not in columns:
+            conn.execute("ALTER TABLE holdings ADD COLUMN max_holdings INTEGER")
+        return conn
+
+    def _covers_holdings_limit(self, holdings: list, stored_limit: int) -> bool:
+        """Whether holdings stored with stored_limit are complete for the current limit"""
+        return stored_limit >= self.holdings_limit or len(holdings) < stored_limit
+
+    def _load_cached_holdings(self) -> dict:
+        """Prune expired rows, then load all unexpired cached holdings in a single query"""
+        cutoff = time.time() - config.HOLDINGS_CACHE_TTL_HOURS * 3600
+        # Remember every wallet with a cache row, expired or not, before pruning
+        self.known_cache_wallets = {
+            wallet for (wallet,) in self.cache_db.execute("SELECT wallet FROM holdings")
+        }
+        self.cache_db.execute("DELETE FROM holdings WHERE ts <= ?", (cutoff,))
+        self.cache_db.commit()
+        rows = self.cache_db.execute(
+            "SELECT wallet, json, max_holdings FROM holdings WHERE ts > ?", (cutoff,)
+        )
+        cached = {}
+        for wallet, holdings_json, max_holdings in rows:
+            holdings = json.loads(holdings_json)
+            if self._covers_holdings_limit(holdings, max_holdings or TOP_HOLDINGS_OUTPUT):
+                cached[wallet] = holdings
+        return cached
+
+    def _cache_holdings(self, wallet: str, holdings: list, fetched_at: float = None, stored_limit: int = None):
+        """Store holdings in memory and on disk, committing in batches"""
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        stored_limit = self.holdings_limit if stored_limit is None else stored_limit
+        self.holdings_cache[wallet] = holdings
+        self.cache_db.execute(
+            "INSERT OR REPLACE INTO holdings(wallet, ts, json, max_holdings) VALUES (?, ?, ?, ?)",
+            (wallet, int(fetched_at), json.dumps(holdings), stored_limit)
+        )
+        self.pending_cache_writes += 1
+        if self.pending_cache_writes >= 100:
+            self.cache_db.commit()
+            self.pending_cache_writes = 0
 
-    def _rate_limit(self):
-        """Implement rate limiting between API calls"""
-        current_time = time.time()
-        time_since_last_call = current_time - self.last_call_time
-        if time_since_last_call < self.backoff_time:
-            time.sleep(self.backoff_time - time_since_last_call)
-        self.last_call_time = time.time()
+    def reuse_holdings(self, previous_holdings: dict, fetched_at: float) -> int:
+        """Seed the cache from a previous output for wallets the cache has never seen"""
+        reused_count = 0
+        for wallet, holdings in previous_holdings.items():
+            # A wallet with any cache row, even an expired one, has a known fetch
+            # time; reviving it from the output file would make stale data look fresh
+            if wallet in self.known_cache_wallets:
+                continue
+            # The CSV only carries TOP_HOLDINGS_OUTPUT holdings per wallet
+            if not self._covers_holdings_limit(holdings, TOP_HOLDINGS_OUTPUT):
+                continue
+            # Persist with the file's age so the TTL applies on later runs
+            self._cache_holdings(wallet, holdings, fetched_at=fetched_at, stored_limit=TOP_HOLDINGS_OUTPUT)
+            reused_count += 1
+        return reused_count
 
-    def _handle_rate_limit(self):
-        """Handle rate limit by increasing backoff time"""
-        self.backoff_time *= 2
-        logger.warning(f"Rate limited. Increasing backoff to {self.backoff_time}s")
-        time.sleep(self.backoff_time)
+    async def close(self):
+        """Close the shared HTTP client and flush the holdings cache"""
+        self.cache_db.commit()
+        self.cache_db.close()
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _parse_retry_after(self, value: str):
+        """Parse a Retry-After header (seconds or HTTP date) into seconds"""
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            # "-0000" dates parse as naive but are UTC per RFC 5322
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0.0, retry_at.timestamp() - time.time())
+
+    def _handle_rate_limit(self, response: httpx.Response):
+        """Handle rate limit by pausing all workers until the cooldown has passed"""
+        now = time.monotonic()
+        retry_after = self._parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            # Never wait longer than our own backoff cap, whatever the header says
+            wait = min(retry_after, self.max_backoff_time)
+            self.backoff_time = max(self.min_call_interval, wait)
+            logger.warning(f"Rate limited. Retrying after {wait:.2f}s")
+        elif self.resume_at > now:
+            # Another worker already started a cooldown for this burst of 429s
+            return
+        else:
+            self.backoff_time = min(self.backoff_time * 2, self.max_backoff_time)
+            logger.warning(f"Rate limited. Increasing backoff to {self.backoff_time}s")
+            wait = self.backoff_time
+        self.resume_at = max(self.resume_at, now + wait)
 
     def _reset_backoff(self):
         """Reset backoff time after successful calls"""
         self.backoff_time = self.min_call_interval
 
-    def get_top_traders(self, limit: int = 2500) -> list:
+    async def _get(self, url: str, params: dict) -> httpx.Response:
+        """Make a rate-limited GET request through the shared client"""
+        if self.client is None:
+            # HTTP/2 multiplexes concurrent requests over one TLS connection;
+            # the pool is sized to the concurrency bound and kept alive
+            # across rate-limit backoff pauses
+            self.client = httpx.AsyncClient(
+                http2=True,
+                headers=self.headers,
+                timeout=10,
+                limits=httpx.Limits(
+                    max_connections=config.MAX_CONCURRENT_REQUESTS,
+                    keepalive_expiry=60
+                )
+            )
+        async with self.semaphore:
+            # Respect any cooldown started by a 429 on another worker
+            while (delay := self.resume_at - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            async with self.limiter:
+                return await self.client.get(url, params=params)
+
+    async def get_top_traders(self, limit: int = 2500) -> list:
         """Fetch top traders from Birdeye API"""
         url = "https://public-api.birdeye.so/trader/gainers-losers"
         traders = []
         
         for offset in range(0, limit, 10):
             retry_count = 0
-            while retry_count < self.max_retries:
+            rate_limited_count = 0
+            while retry_count < self.max_retries and rate_limited_count < self.max_rate_limit_retries:
                 try:
-                    self._rate_limit()
                     params = {
                         "type": "1W",
                         "offset": offset,
                         "limit": 10
                     }
                     
-                    response = requests.get(url, headers=self.headers, params=params)
+                    response = await self._get(url, params)
                     if response.status_code == 429:
-                        self._handle_rate_limit()
-                        retry_count += 1
+                        self._handle_rate_limit(response)
+                        rate_limited_count += 1
                         continue
                     
                     if response.status_code != 200:
@@ -103,32 +241,32 @@ class WalletAnalyzer:
                 except Exception as e:
                     logger.error(f"Error fetching traders: {e}")
                     retry_count += 1
-                    time.sleep(1)
+                    await asyncio.sleep(1)
             
-            if retry_count == self.max_retries:
+            if retry_count == self.max_retries or rate_limited_count == self.max_rate_limit_retries:
                 logger.error(f"Max retries reached for offset {offset}")
                 
         return traders
 
-    def get_wallet_holdings(self, wallet: str) -> list:
+    async def get_wallet_holdings(self, wallet: str) -> list:
         """Get holdings for a wallet with value above threshold"""
         # Check cache first
         if wallet in self.holdings_cache:
             return self.holdings_cache[wallet]
 
         retry_count = 0
-        while retry_count < self.max_retries:
+        rate_limited_count = 0
+        while retry_count < self.max_retries and rate_limited_count < self.max_rate_limit_retries:
             try:
-                self._rate_limit()
                 url = "https://public-api.birdeye.so/v1/wallet/token_list"
                 params = {"wallet": wallet}
                 
                 logger.info(f"Fetching holdings for wallet: {wallet}")
-                response = requests.get(url, headers=self.headers, params=params, timeout=10)
+                response = await self._get(url, params)
                 
                 if response.status_code == 429:
-                    self._handle_rate_limit()
-                    retry_count += 1
+                    self._handle_rate_limit(response)
+                    rate_limited_count += 1
                     continue
                 
                 if response.status_code != 200:
@@ -144,147 +282,181 @@ class WalletAnalyzer:
                 holdings = data.get("data", {}).get("items", [])
                 if not holdings:
                     logger.info(f"No holdings found for wallet {wallet}")
-                    self.holdings_cache[wallet] = []
+                    self._cache_holdings(wallet, [])
                     return []
                 
-                # Filter and sort holdings by value
-                significant_holdings = [
-                    h for h in holdings 
-                    if h.get("valueUsd", 0) >= config.SIGNIFICANT_HOLDING_THRESHOLD 
-                    and h.get("symbol") and h.get("valueUsd")
-                    and h.get("symbol") not in ["USDC", "SOL"]
-                ]
-                significant_holdings.sort(key=lambda x: float(x.get("valueUsd", 0)), reverse=True)
+                # Keep only the top significant holdings used downstream,
+                # selected with a bounded heap instead of a full sort
+                significant_holdings = heapq.nlargest(
+                    self.holdings_limit,
+                    (
+                        h for h in holdings
+                        if (h.get("valueUsd") or 0) >= config.SIGNIFICANT_HOLDING_THRESHOLD
+                        and h.get("symbol")
+                        and h.get("symbol") not in ("USDC", "SOL")
+                    ),
+                    key=lambda x: float(x["valueUsd"])
+                )
                 
                 # Format holdings with more decimals
-                formatted_holdings = []
-                for holding in significant_holdings:
-                    value_millions = float(holding.get("valueUsd", 0)) / 1_000_000
-                    formatted = f"{holding.get('symbol')} {value_millions:.2f}m"
-                    formatted_holdings.append(formatted)
+                formatted_holdings = [
+                    f"{holding['symbol']} {float(holding['valueUsd']) / 1_000_000:.2f}m"
+                    for holding in significant_holdings
+                ]
                 
                 logger.info(f"Found {len(formatted_holdings)} significant holdings for {wallet}")
                 
                 # Cache the results
-                self.holdings_cache[wallet] = formatted_holdings
+                self._cache_holdings(wallet, formatted_holdings)
                 self._reset_backoff()
                 return formatted_holdings
                 
-            except requests.exceptions.Timeout:
+            except httpx.TimeoutException:
                 logger.error(f"Timeout fetching holdings for wallet {wallet}")
                 retry_count += 1
-                time.sleep(1)
-            except requests.exceptions.RequestException as e:
+                await asyncio.sleep(1)
+            except httpx.HTTPError as e:
                 logger.error(f"Request error fetching holdings for wallet {wallet}: {e}")
                 retry_count += 1
-                time.sleep(1)
+                await asyncio.sleep(1)
             except Exception as e:
                 logger.error(f"Error fetching holdings for {wallet}: {e}")
                 retry_count += 1
-                time.sleep(1)
+                await asyncio.sleep(1)
         
-        if retry_count == self.max_retries:
+        if retry_count == self.max_retries or rate_limited_count == self.max_rate_limit_retries:
             logger.error(f"Max retries reached for wallet {wallet}")
             return []
 
-    def calculate_trading_score(self, trader_data: dict) -> TraderMetrics:
-        """Calculate trading metrics and score"""
-        pnl = float(trader_data.get('pnl', 0))
-        volume = float(trader_data.get('volume', 0))
-        trade_count = int(trader_data.get('trade_count', 0))
+    def calculate_trading_scores(self, traders: list) -> pd.DataFrame:
+        """Calculate trading metrics and scores for all traders at once"""
+        df = pd.DataFrame(traders, columns=['address', 'pnl', 'volume', 'trade_count'])
+        for col in ['pnl', 'volume', 'trade_count']:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(float)
+        df['trade_count'] = df['trade_count'].astype(int)
+        
+        # Drop bots and inactive wallets
+        df = df[(df['trade_count'] > 0) & (df['trade_count'] <= config.BOT_TRANSACTION_THRESHOLD)].copy()
         
-        if trade_count > config.BOT_TRANSACTION_THRESHOLD or trade_count == 0:
-            return None
-            
         # Calculate efficiency score
-        efficiency = (pnl / volume * 100) if volume > 0 else 0
-        efficiency_score = min(100, (pnl / volume) * 200) if volume > 0 else 0
+        df['efficiency_score'] = (df['pnl'] / df['volume'] * 200).clip(upper=100).where(df['volume'] > 0, 0)
         
         # Calculate trading score components
-        pnl_score = min(100, pnl / 100000)
-        profit_per_trade = pnl / trade_count
-        activity_score = min(100, max(0, (profit_per_trade - 1000) / 19000 * 100))
+        pnl_score = (df['pnl'] / 100000).clip(upper=100)
+        profit_per_trade = df['pnl'] / df['trade_count']
+        activity_score = ((profit_per_trade - 1000) / 19000 * 100).clip(lower=0, upper=100)
         
         # Final trading score
-        trading_score = (
-            efficiency_score * 0.33 +
+        df['trading_score'] = (
+            df['efficiency_score'] * 0.33 +
             pnl_score * 0.33 +
             activity_score * 0.34
         )
         
-        return TraderMetrics(
-            address=trader_data.get('address'),
-            pnl=pnl,
-            volume=volume,
-            trade_count=trade_count,
-            efficiency_score=efficiency_score,
-            trading_score=trading_score
-        )
+        # Keep the first occurrence of each wallet, best scores first
+        df = df.drop_duplicates('address', keep='first')
+        return df.sort_values('trading_score', ascending=False, kind='stable')
 
-def main():
+def load_previous_holdings(output_file: str) -> dict:
+    """Load top holdings from the previous run's output if it is still fresh"""
+    if not os.path.exists(output_file):
+        return {}
+    if time.time() - os.path.getmtime(output_file) >= config.HOLDINGS_CACHE_TTL_HOURS * 3600:
+        return {}
+    
+    try:
+        prev = pd.read_csv(output_file, usecols=lambda c: c == 'Wallet' or c.startswith('Top_Holding_'))
+        holding_cols = [c for c in prev.columns if c != 'Wallet']
+        return {
+            wallet: [h for h in holdings if pd.notna(h)]
+            for wallet, holdings in zip(prev['Wallet'], prev[holding_cols].itertuples(index=False))
+        }
+    except (pd.errors.EmptyDataError, ValueError, KeyError) as e:
+        logger.warning(f"Could not reuse holdings from {output_file}: {e}")
+        return {}
+
+async def fetch_trader_holdings(analyzer: WalletAnalyzer, trader: TraderMetrics) -> TraderMetrics:
+    """Fetch holdings for a trader, returning the trader with top_holdings set"""
+    try:
+        trader.top_holdings = await analyzer.get_wallet_holdings(trader.address)
+    except Exception as e:
+        logger.error(f"Error processing trader {trader.address}: {e}")
+    return trader
+
+async def analyze():
     # Ensure output directory exists
     os.makedirs("output", exist_ok=True)
     
     analyzer = WalletAnalyzer(d.birdeye_api_key)
     
-    # 1. Get top 2.5k traders
-    logger.info(f"Fetching top {config.TOP_GAINERS_LIMIT} traders...")
-    traders = analyzer.get_top_traders(limit=config.TOP_GAINERS_LIMIT)
-    
-    # 2. Process and filter traders, removing duplicates and bots
-    logger.info("Processing trader metrics...")
-    seen_addresses = set()
-    processed_traders = []
-    for trader in traders:
-        metrics = analyzer.calculate_trading_score(trader)
-        if metrics and metrics.address not in seen_addresses:  # Only add if not seen before
-            seen_addresses.add(metrics.address)
-            processed_traders.append(metrics)
+    try:
+        # 1. Get top 2.5k traders
+        logger.info(f"Fetching top {config.TOP_GAINERS_LIMIT} traders...")
+        traders = await analyzer.get_top_traders(limit=config.TOP_GAINERS_LIMIT)
     
-    # 3. Sort by trading score
-    processed_traders.sort(key=lambda x: x.trading_score, reverse=True)
-    logger.info(f"Found {len(processed_traders)} unique qualified traders after filtering")
+        # 2. Score traders, removing duplicates and bots, sorted by trading score
+        logger.info("Processing trader metrics...")
+        scored = analyzer.calculate_trading_scores(traders)
+        logger.info(f"Found {len(scored)} unique qualified traders after filtering")
     
-    # 4. Get holdings for all qualified traders
-    logger.info("Fetching holdings for all qualified traders...")
-    for i, trader in enumerate(processed_traders, 1):
-        logger.info(f"Processing trader {i}/{len(processed_traders)}")
-        try:
-            trader.top_holdings = analyzer.get_wallet_holdings(trader.address)
-        except Exception as e:
-            logger.error(f"Error processing trader {trader.address}: {e}")
-            continue
+        # 3. Keep only the best candidates for the holdings fetch
+        processed_traders = [
+            TraderMetrics(**row._asdict())
+            for row in scored.head(config.HOLDINGS_FETCH_CAP).itertuples(index=False)
+        ]
     
-    # 5. Filter for traders with at least 2 significant token positions
-    qualified_traders = [
-        trader for trader in processed_traders
-        if trader.top_holdings and len(trader.top_holdings) >= config.MIN_SIGNIFICANT_HOLDINGS
-    ]
-    logger.info(f"Found {len(qualified_traders)} traders with {config.MIN_SIGNIFICANT_HOLDINGS}+ significant token positions")
+        # 4. Get holdings for the top qualified traders concurrently, streaming
+        #    traders with at least 2 significant token positions to CSV as they complete
+        logger.info(f"Fetching holdings for top {len(processed_traders)} qualified traders...")
+        output_file = "output/wallet_holdings.csv"
     
-    # 6. Save final results with fixed filename
-    output_file = "output/wallet_holdings.csv"
+        # Reuse holdings from a recent previous run instead of refetching them
+        previous_holdings = load_previous_holdings(output_file)
+        reused_count = 0
+        if previous_holdings:
+            reused_count = analyzer.reuse_holdings(previous_holdings, os.path.getmtime(output_file))
+        if reused_count:
+            logger.info(f"Reusing holdings for {reused_count} wallets from previous run")
+        fieldnames = [
+            'Wallet', 'PnL', 'Volume', 'Trade_Count', 'Efficiency_Score', 'Trading_Score'
+        ] + [f'Top_Holding_{i}' for i in range(1, TOP_HOLDINGS_OUTPUT + 1)]
+        qualified_count = 0
     
-    # Prepare data for CSV
-    data = []
-    for trader in qualified_traders:
-        row = {
-            'Wallet': trader.address,
-            'PnL': trader.pnl,
-            'Volume': trader.volume,
-            'Trade_Count': trader.trade_count,
-            'Efficiency_Score': trader.efficiency_score,
-            'Trading_Score': trader.trading_score
-        }
-        # Add top holdings
-        for i, holding in enumerate(trader.top_holdings[:5] if trader.top_holdings else [], 1):
-            row[f'Top_Holding_{i}'] = holding
-        data.append(row)
+        # Overwrite any existing file
+        with open(output_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+        
+            for next_done in asyncio.as_completed(
+                [fetch_trader_holdings(analyzer, trader) for trader in processed_traders]
+            ):
+                trader = await next_done
+                if not trader.top_holdings or len(trader.top_holdings) < config.MIN_SIGNIFICANT_HOLDINGS:
+                    continue
+            
+                row = {
+                    'Wallet': trader.address,
+                    'PnL': trader.pnl,
+                    'Volume': trader.volume,
+                    'Trade_Count': trader.trade_count,
+                    'Efficiency_Score': trader.efficiency_score,
+                    'Trading_Score': trader.trading_score
+                }
+                # Add top holdings
+                for i, holding in enumerate(trader.top_holdings[:TOP_HOLDINGS_OUTPUT], 1):
+                    row[f'Top_Holding_{i}'] = holding
+                writer.writerow(row)
+                f.flush()  # Keep progress on disk if the run is interrupted
+                qualified_count += 1
     
-    # Save to CSV, overwriting any existing file
-    df = pd.DataFrame(data)
-    df.to_csv(output_file, index=False)
-    logger.info(f"Results saved to {output_file}")
+        logger.info(f"Found {qualified_count} traders with {config.MIN_SIGNIFICANT_HOLDINGS}+ significant token positions")
+        logger.info(f"Results saved to {output_file}")
+    finally:
+        # Flush the holdings cache and release the client even if the run fails
+        await analyzer.close()
+
+def main():
+    asyncio.run(analyze())
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
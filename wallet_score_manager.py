@@ -1,25 +1,32 @@
 import pandas as pd
+import numpy as np
 import os
 from datetime import datetime
 import glob
 
 def load_historical_data():
-    """Load historical data if exists, otherwise create new"""
+    """Load historical data indexed by wallet address if exists, otherwise create new"""
     script_dir = os.path.dirname(os.path.abspath(__file__))
     historical_dir = os.path.join(script_dir, "historical")
-    historical_file = os.path.join(historical_dir, "all_wallets.csv")
+    historical_file = os.path.join(historical_dir, "all_wallets.parquet")
+    legacy_file = os.path.join(historical_dir, "all_wallets.csv")
+    columns = ['Wallet_Address', 'composite_score', 'last_seen', 'appearances']
     
     if not os.path.exists(historical_dir):
         os.makedirs(historical_dir)
         
     if os.path.exists(historical_file):
-        historical_df = pd.read_csv(historical_file)
+        historical_df = pd.read_parquet(historical_file, columns=columns)
         print(f"Loaded {len(historical_df)} wallets from historical records")
+    elif os.path.exists(legacy_file):
+        # One-time migration from the old CSV format
+        historical_df = pd.read_csv(legacy_file, usecols=columns)
+        print(f"Loaded {len(historical_df)} wallets from legacy CSV historical records")
     else:
-        historical_df = pd.DataFrame(columns=['Wallet_Address', 'composite_score', 'last_seen', 'appearances'])
+        historical_df = pd.DataFrame(columns=columns)
         print("Created new historical tracking file")
     
-    return historical_df
+    return historical_df.set_index('Wallet_Address')
 
 def load_latest_analysis():
     """Load the most recent wallet analysis results"""
@@ -32,92 +39,97 @@ def load_latest_analysis():
     print(f"Loading analysis from {analysis_file}")
     return pd.read_csv(analysis_file)
 
+def top_wallets(historical_df, n=300):
+    """Return the n highest-scoring wallets, sorted by composite score"""
+    # Unscored wallets never rank, matching nlargest
+    historical_df = historical_df[historical_df['composite_score'].notna()]
+    scores = historical_df['composite_score'].to_numpy(dtype=float)
+    if len(scores) > n:
+        # Partial selection instead of sorting the full history
+        historical_df = historical_df.iloc[np.argpartition(scores, -n)[-n:]]
+    return historical_df.sort_values('composite_score', ascending=False)
+
 def format_for_crystalized(df):
     """Format dataframe into crystalized wallet format"""
-    crystalized_data = []
-    
-    for _, row in df.iterrows():
-        crystalized_row = {
-            'Appearances': row.get('appearances', 1.0),
-            'Wallet': f"https://gmgn.ai/sol/address/{row['Wallet_Address']}",
-            'Wallet_Address': row['Wallet_Address'],
-            'SOL_Balance': 0.0,
-            'Token_Value_SOL': 0.0,
-            'Token_Count': 0.0,
-            'Win_Rate_30d': 0.0,
-            'pnl_7d_percent': '+0.00%',
-            'pnl_7d_usd': f"+${row.get('PnL', 0):,.0f}",
-            'win_rate': '0.00%',
-            'score': row['composite_score']
-        }
-        crystalized_data.append(crystalized_row)
-    
-    return pd.DataFrame(crystalized_data)
+    pnl = df.get('PnL', pd.Series(0, index=df.index))
+    
+    return pd.DataFrame({
+        'Appearances': df.get('appearances', 1.0),
+        'Wallet': 'https://gmgn.ai/sol/address/' + df['Wallet_Address'].astype(str),
+        'Wallet_Address': df['Wallet_Address'],
+        'SOL_Balance': 0.0,
+        'Token_Value_SOL': 0.0,
+        'Token_Count': 0.0,
+        'Win_Rate_30d': 0.0,
+        'pnl_7d_percent': '+0.00%',
+        'pnl_7d_usd': '+$' + pnl.map('{:,.0f}'.format).astype(str),
+        'win_rate': '0.00%',
+        'score': df['composite_score']
+    })
 
 def update_scores():
     """Main process to update scores and generate new crystalized list"""
     # Load data
     historical_df = load_historical_data()
     current_df = load_latest_analysis()
+    today = datetime.now().strftime("%Y-%m-%d")
     
     # Initialize tracking metrics
-    wallets_updated = 0
-    wallets_new = 0
     significant_changes = []
     
-    # Get current top 300 before updates
-    previous_top_300 = set(historical_df.nlargest(300, 'composite_score')['Wallet_Address']) if not historical_df.empty else set()
-    
-    # Process each wallet in current analysis
-    for _, row in current_df.iterrows():
-        wallet = row['Wallet']
-        current_score = row['Trading_Score']
-        
-        if wallet in historical_df['Wallet_Address'].values:
-            # Update existing wallet
-            hist_score = historical_df.loc[historical_df['Wallet_Address'] == wallet, 'composite_score'].iloc[0]
-            appearances = historical_df.loc[historical_df['Wallet_Address'] == wallet, 'appearances'].iloc[0] + 1
-            new_score = (hist_score * 0.7) + (current_score * 0.3)
-            
-            # Track significant score changes (>20% change)
-            score_change_pct = ((new_score - hist_score) / hist_score * 100) if hist_score > 0 else 100
-            if abs(score_change_pct) > 20:
-                significant_changes.append({
-                    'wallet': wallet,
-                    'old_score': hist_score,
-                    'new_score': new_score,
-                    'change_pct': score_change_pct
-                })
-            
-            # Update historical record
-            historical_df.loc[historical_df['Wallet_Address'] == wallet, 'composite_score'] = new_score
-            historical_df.loc[historical_df['Wallet_Address'] == wallet, 'appearances'] = appearances
-            wallets_updated += 1
-        else:
-            # Add new wallet
-            new_row = {
-                'Wallet_Address': wallet,
-                'composite_score': current_score,
-                'appearances': 1,
-                'last_seen': datetime.now().strftime("%Y-%m-%d")
-            }
-            historical_df = pd.concat([historical_df, pd.DataFrame([new_row])], ignore_index=True)
-            wallets_new += 1
+    # Get current top 300 ranks before updates
+    previous_rank = {wallet: rank for rank, wallet in enumerate(top_wallets(historical_df).index, 1)}
+    
+    # Align current scores with historical records by wallet address
+    current_scores = (
+        current_df.drop_duplicates('Wallet')
+        .set_index('Wallet')['Trading_Score']
+        .rename_axis('Wallet_Address')
+    )
+    is_existing = current_scores.index.isin(historical_df.index)
+    existing_scores = current_scores[is_existing]
+    new_scores = current_scores[~is_existing]
+    
+    # Update existing wallets
+    hist_scores = historical_df.loc[existing_scores.index, 'composite_score']
+    updated_scores = (hist_scores * 0.7) + (existing_scores * 0.3)
+    
+    # Track significant score changes (>20% change)
+    score_change_pct = ((updated_scores - hist_scores) / hist_scores * 100).where(hist_scores > 0, 100)
+    for wallet in score_change_pct.index[score_change_pct.abs() > 20]:
+        significant_changes.append({
+            'wallet': wallet,
+            'old_score': hist_scores[wallet],
+            'new_score': updated_scores[wallet],
+            'change_pct': score_change_pct[wallet]
+        })
+    
+    # Update historical records
+    historical_df.loc[existing_scores.index, 'composite_score'] = updated_scores
+    historical_df.loc[existing_scores.index, 'appearances'] += 1
+    wallets_updated = len(existing_scores)
+    
+    # Add new wallets in a single concat
+    if not new_scores.empty:
+        new_rows = pd.DataFrame({'composite_score': new_scores, 'appearances': 1, 'last_seen': today})
+        historical_df = pd.concat([historical_df, new_rows]) if not historical_df.empty else new_rows
+    wallets_new = len(new_scores)
     
     # Update last_seen for all current wallets
-    current_wallets = current_df['Wallet'].values
-    historical_df.loc[historical_df['Wallet_Address'].isin(current_wallets), 'last_seen'] = datetime.now().strftime("%Y-%m-%d")
-    
-    # Sort by composite score
-    historical_df = historical_df.sort_values('composite_score', ascending=False)
+    historical_df.loc[current_scores.index, 'last_seen'] = today
     
     # Get new top 300 and analyze changes
-    new_top_300 = set(historical_df.head(300)['Wallet_Address'])
-    dropped_from_top = previous_top_300 - new_top_300
-    added_to_top = new_top_300 - previous_top_300
+    new_top = top_wallets(historical_df)
+    new_rank = {wallet: rank for rank, wallet in enumerate(new_top.index, 1)}
+    dropped_from_top = previous_rank.keys() - new_rank.keys()
+    added_to_top = new_rank.keys() - previous_rank.keys()
     
     # Save full historical data
-    historical_df.to_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "historical/all_wallets.csv"), index=False)
+    historical_df.reset_index().to_parquet(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "historical/all_wallets.parquet"),
+        index=False,
+        compression='zstd'
+    )
     
     # Print summary statistics
     print("\n=== Update Summary ===")
@@ -133,21 +145,21 @@ def update_scores():
     print(f"Dropped from top 300: {len(dropped_from_top)} wallets")
     if dropped_from_top:
         print("Notable drops (top 100 → out):")
-        for wallet in dropped_from_top:
-            old_rank = list(previous_top_300).index(wallet) + 1
+        for wallet in sorted(dropped_from_top, key=previous_rank.get):
+            old_rank = previous_rank[wallet]
             if old_rank <= 100:
                 print(f"  {wallet[:8]}... (was rank {old_rank})")
     
     print(f"New to top 300: {len(added_to_top)} wallets")
     if added_to_top:
         print("Notable additions (→ top 100):")
-        for wallet in added_to_top:
-            new_rank = list(new_top_300).index(wallet) + 1
-            if new_rank <= 100:
-                print(f"  {wallet[:8]}... (now rank {new_rank})")
+        for wallet in sorted(added_to_top, key=new_rank.get):
+            rank = new_rank[wallet]
+            if rank <= 100:
+                print(f"  {wallet[:8]}... (now rank {rank})")
     
     # Format and save new crystalized list
-    top_300 = historical_df.head(300)
+    top_300 = new_top.reset_index()
     crystalized_df = format_for_crystalized(top_300)
     
     # Save new crystalized list with fixed filename